@@ -3,15 +3,35 @@
 # Install: pip install python-telegram-bot==20.7
 
 import os
+import re
 import json
 import time
-import zipfile
+import logging
+import atexit
+import asyncio
+import secrets
+import hashlib
+import hmac
+import mmap
+import uuid
+import bisect
 import tarfile
 from io import BytesIO
-from tempfile import NamedTemporaryFile
-from shutil import move
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
+try:
+    import orjson
+except ImportError:  # fall back to stdlib json
+    orjson = None
+
+try:
+    import zstandard as zstd
+except ImportError:  # fall back to gzip backups
+    zstd = None
+
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -29,6 +49,8 @@ from telegram.ext import (
     filters,
 )
 
+logger = logging.getLogger(__name__)
+
 # ---------------- CONFIG ----------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")  # Bot token from environment
 OWNER_ID = int(os.getenv("OWNER_ID", "6065778458"))  # Admin user ID
@@ -38,7 +60,36 @@ BACKUPS_DIR = "backups"
 USERS_FILE = "data/users.json"
 
 UPTIME_START = time.time()
-SCHEMA_VERSION = 2  # Current schema version
+SCHEMA_VERSION = 4  # Current schema version
+MIGRATION_BATCH = 1000  # user files migrated per batch at startup
+BACKUP_INDEX = os.path.join(BACKUPS_DIR, "index.json")  # state of the last prestart backup
+BACKUP_MANIFEST_NAME = "backup_manifest.json"
+FULL_BACKUP_EVERY = 7  # incremental prestart backups between full ones
+FULL_BACKUP_MAX_AGE = 7 * 24 * 3600  # ...and take a full one at least weekly
+BACKUP_COPY_BUFSIZE = 1024 * 1024  # tarfile's default 16 KiB copy chunks are tiny
+LOG_COMPACT_RATIO = 4  # fold the op log into the user file once it is this many times larger
+# fsync every file write and op-log append (FSYNC=1) for power-loss durability;
+# by default writes are atomic renames only, which survive a crash or SIGKILL
+# of the bot itself
+FSYNC_ON_WRITE = os.getenv("FSYNC", "0") == "1"
+
+# In-memory copy of USERS_FILE; reloaded only when its (mtime_ns, size) changes
+_USERS_CACHE = None
+_USERS_STAT = None
+_LOGGED_IN = set()  # int user_ids whose users.json entry has logged_in set
+
+# Parsed per-user data, most recently used last; written through on save
+USER_CACHE_SIZE = 512
+_USER_DATA_CACHE = OrderedDict()
+_USER_DATA_STAT = {}  # user_id -> (mtime_ns, size) of the file the cached copy matches
+_SEARCH_INDEX = {}  # user_id -> (lowercased blob of all sections, start offsets); never persisted
+
+# Users whose cached data has not been written yet; flushed after FLUSH_DELAY seconds
+FLUSH_DELAY = 0.5
+_DIRTY = set()
+_WRITING = set()  # users whose file is being written by an off-loop save
+_USERS_DIRTY = False  # the cached users dict has changes not yet in USERS_FILE
+_FLUSH_HANDLE = None
 # ----------------------------- END CONFIG ----------------
 
 # Ensure folders/files exist
@@ -49,54 +100,243 @@ if not os.path.exists(USERS_FILE):
         json.dump({}, f, indent=2)
 
 # ---------- Safe JSON helpers ----------
-def safe_write_json(path: str, obj):
+def json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def json_dumps(obj, indent: bool = False) -> bytes:
+    # Compact unless asked otherwise; indent means two spaces (all orjson supports)
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def json_line(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+def read_json(path: str):
+    with open(path, "rb") as f:
+        return json_loads(f.read())
+
+def safe_write_json(path: str, obj, fsync=None, indent: bool = False, sync_dir: bool = True):
+    # Without fsync this is still an atomic replace, but the newest contents
+    # may be lost on power failure. fsync=None follows FSYNC_ON_WRITE;
+    # sync_dir=False leaves the directory fsync to a caller writing a batch.
+    if fsync is None:
+        fsync = FSYNC_ON_WRITE
     dirn = os.path.dirname(path) or "."
-    with NamedTemporaryFile("w", dir=dirn, delete=False, encoding="utf-8") as tf:
-        json.dump(obj, tf, ensure_ascii=False, indent=2)
-        tf.flush()
+    tmpname = os.path.join(
+        dirn, f".{os.path.basename(path)}.{os.getpid()}.{secrets.token_hex(4)}.tmp"
+    )
+    fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, "wb") as tf:
+            tf.write(json_dumps(obj, indent=indent))
+            tf.flush()
+            if fsync:
+                try:
+                    os.fsync(tf.fileno())
+                except:
+                    pass
+        os.replace(tmpname, path)
+    except BaseException:
         try:
-            os.fsync(tf.fileno())
-        except:
+            os.unlink(tmpname)
+        except OSError:
             pass
-        tmpname = tf.name
-    move(tmpname, path)
+        raise
+    if fsync and sync_dir:
+        fsync_dir(dirn)
+
+def fsync_dir(dirn: str):
+    # Persist the rename itself; Windows has no directory fsync and some
+    # network filesystems (SMB, NFS) reject it, which is not worth failing a write over
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    try:
+        dfd = os.open(dirn, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        os.fsync(dfd)
+    except OSError:
+        pass
+    finally:
+        os.close(dfd)
+
+def is_valid_json_bytes(raw) -> bool:
+    try:
+        json_loads(raw)
+        return True
+    except Exception:
+        return False
 
 def is_valid_json_file(path: str) -> bool:
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            json.load(f)
+        if orjson is None:
+            read_json(path)
+            return True
+        # Parse straight out of the page cache instead of copying into a bytes object
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                orjson.loads(view)
         return True
     except Exception:
         return False
 
+def scan_data_dir():
+    # DATA_DIR is flat ({user_id}.json plus journals), so one scandir pass is enough
+    with os.scandir(DATA_DIR) as it:
+        return [e for e in it if e.is_file(follow_symlinks=False)]
+
+def prestart_snapshot(entries):
+    """Map every file covered by the prestart backup to its os.stat result."""
+    stats = {e.path: e.stat(follow_symlinks=False) for e in entries}
+    if USERS_FILE not in stats and os.path.exists(USERS_FILE):
+        stats[USERS_FILE] = os.stat(USERS_FILE)
+    return stats
+
+def write_prestart_tar(stem: str, members, stats, manifest, on_read=None) -> str:
+    if zstd is not None:
+        tarname = os.path.join(BACKUPS_DIR, f"{stem}.tar.zst")
+        cctx = zstd.ZstdCompressor(level=3, threads=-1)
+        with open(tarname, "wb") as out, cctx.stream_writer(out) as zw, \
+                tarfile.open(fileobj=zw, mode="w|", copybufsize=BACKUP_COPY_BUFSIZE) as tar:
+            add_prestart_files(tar, members, stats, manifest, on_read)
+    else:
+        tarname = os.path.join(BACKUPS_DIR, f"{stem}.tar.gz")
+        with tarfile.open(tarname, "w:gz", compresslevel=6,
+                          copybufsize=BACKUP_COPY_BUFSIZE) as tar:
+            add_prestart_files(tar, members, stats, manifest, on_read)
+    return tarname
+
+def add_prestart_files(tar, members, stats, manifest, on_read=None):
+    # Build headers from the stat we already have instead of letting tar.add()
+    # re-stat; on_read(path, raw) lets the caller reuse the bytes we just read.
+    for p in members:
+        st = stats[p]
+        with open(p, "rb") as fh:
+            raw = fh.read()
+        ti = tarfile.TarInfo(p)
+        ti.size = len(raw)
+        ti.mtime = int(st.st_mtime)
+        ti.mode = st.st_mode & 0o7777
+        tar.addfile(ti, BytesIO(raw))
+        if on_read is not None:
+            on_read(p, raw)
+    raw = json_dumps(manifest, indent=True)
+    ti = tarfile.TarInfo(BACKUP_MANIFEST_NAME)
+    ti.size = len(raw)
+    ti.mtime = int(time.time())
+    tar.addfile(ti, BytesIO(raw))
+
+def prestart_backup(entries=None, on_read=None):
+    """Write a full or incremental prestart backup; return its path (None if unchanged).
+
+    An incremental archive holds only files whose (mtime, size) changed since
+    the previous backup. Its manifest names the full backup it builds on and
+    every file that existed, so a restore can replay the chain and drop
+    deleted files.
+    """
+    stats = prestart_snapshot(scan_data_dir() if entries is None else entries)
+    files = {p: [st.st_mtime_ns, st.st_size] for p, st in stats.items()}
+    try:
+        index = read_json(BACKUP_INDEX)
+    except Exception:
+        index = {}  # missing or unreadable: start a new chain
+    prev = index.get("files", {})
+    changed = sorted(p for p, sig in files.items() if prev.get(p) != sig)
+    full = (
+        not index.get("base")
+        or index.get("incrementals", 0) >= FULL_BACKUP_EVERY
+        or time.time() - index.get("base_time", 0) > FULL_BACKUP_MAX_AGE
+        or len(changed) * 2 > len(files)
+    )
+    if not full and not changed and files.keys() == prev.keys():
+        return None
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if full:
+        tarname = write_prestart_tar(f"prestart_{ts}", sorted(files), stats, {"base": None, "files": sorted(files)}, on_read)
+        index = {"base": os.path.basename(tarname), "base_time": int(time.time()), "incrementals": 0}
+    else:
+        tarname = write_prestart_tar(f"prestart_{ts}_incr", changed, stats, {"base": index["base"], "files": sorted(files)}, on_read)
+        index["incrementals"] += 1
+    index["files"] = files
+    safe_write_json(BACKUP_INDEX, index)
+    return tarname
+
 def startup_backup_and_check():
     """Create a pre-start backup and validate JSON files."""
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    tarname = os.path.join(BACKUPS_DIR, f"prestart_{ts}.tar.gz")
-    with tarfile.open(tarname, "w:gz") as tar:
-        if os.path.exists(USERS_FILE):
-            tar.add(USERS_FILE)
-        if os.path.exists(DATA_DIR):
-            tar.add(DATA_DIR)
-    # validate JSONs
-    bad = []
-    if os.path.exists(USERS_FILE) and not is_valid_json_file(USERS_FILE):
-        bad.append(USERS_FILE)
-    for root, _, files in os.walk(DATA_DIR):
-        for f in files:
-            p = os.path.join(root, f)
-            if not is_valid_json_file(p):
-                bad.append(p)
+    entries = scan_data_dir()
+    users_file = os.path.abspath(USERS_FILE)
+    user_paths = [
+        e.path for e in entries
+        if e.name.endswith(".json") and os.path.abspath(e.path) != users_file
+    ]
+    paths = ([USERS_FILE] if os.path.exists(USERS_FILE) else []) + user_paths
+    wanted = set(paths)
+    checks = {}
+    workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        # Files the backup reads are validated from those same bytes while the
+        # tar keeps streaming; only files it skips are read a second time.
+        def validate_read(p, raw):
+            if p in wanted:
+                checks[p] = ex.submit(is_valid_json_bytes, raw)
+        prestart_backup(entries, on_read=validate_read)
+        for p in paths:
+            if p not in checks:
+                checks[p] = ex.submit(is_valid_json_file, p)
+        bad = [p for p in paths if not checks[p].result()]
     if bad:
         raise RuntimeError(f"Startup JSON validation failed for: {bad}")
+    migrate_users_file()
+    migrate_all_user_files(user_paths)
 
 # ---------- Data helpers ----------
+def _index_users(users):
+    global _USERS_CACHE, _LOGGED_IN
+    _USERS_CACHE = users
+    _LOGGED_IN = {
+        int(k) for k, v in users.items()
+        if k.isdigit() and isinstance(v, dict) and v.get("logged_in")
+    }
+
+def _users_stat():
+    st = os.stat(USERS_FILE)
+    return st.st_mtime_ns, st.st_size
+
 def load_users():
-    with open(USERS_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    global _USERS_STAT
+    sig = _users_stat()
+    # like user data, unflushed changes win over the file on disk
+    if _USERS_CACHE is None or (not _USERS_DIRTY and sig != _USERS_STAT):
+        _index_users(read_json(USERS_FILE))
+        _USERS_STAT = sig
+    return _USERS_CACHE
+
+def _write_users(users, fsync=None, sync_dir: bool = True):
+    global _USERS_STAT
+    safe_write_json(USERS_FILE, users, fsync=fsync, indent=True, sync_dir=sync_dir)
+    _USERS_STAT = _users_stat()
 
-def save_users(users):
-    safe_write_json(USERS_FILE, users)
+def save_users(users, immediate: bool = False):
+    """Cache `users` and schedule a write; `immediate=True` writes it now."""
+    global _USERS_DIRTY
+    _index_users(users)
+    if immediate:
+        _USERS_DIRTY = False
+        _write_users(users)
+    else:
+        _USERS_DIRTY = True
+        _schedule_flush()
 
 def user_data_path(user_id: int) -> str:
     return os.path.join(DATA_DIR, f"{user_id}.json")
@@ -107,55 +347,464 @@ def default_user_structure():
         "sections": [],
         "trash": [],
         "settings": {"theme": "light"},
+        "stats": {"n_sections": 0, "n_favorites": 0, "total_words": 0},
+        "favorites": [],
+        "by_id": {},
     }
 
+# ---------- Stats ----------
+# data["stats"] holds counters derived from sections, so menus and /stats
+# never rescan every section's text.
+def _section_counts(section):
+    return 1, int(bool(section.get("favorite"))), count_words(section.get("text", ""))
+
+def _adjust_stats(data, section, sign: int):
+    stats = data.setdefault("stats", {"n_sections": 0, "n_favorites": 0, "total_words": 0})
+    n, fav, words = _section_counts(section)
+    stats["n_sections"] += sign * n
+    stats["n_favorites"] += sign * fav
+    stats["total_words"] += sign * words
+
+def refresh_stats(data):
+    data["stats"] = {"n_sections": 0, "n_favorites": 0, "total_words": 0}
+    for s in data.get("sections", []):
+        s.pop("_wc", None)  # per-section memo from older builds; counts are cached in memory now
+        _adjust_stats(data, s, 1)
+    return data["stats"]
+
+# ---------- Section indexes ----------
+# Every section gets a stable "id"; data["by_id"] maps it to the section's
+# position and data["favorites"] lists favorite positions in order.
+def reindex_sections(data):
+    by_id, favorites = {}, []
+    for i, s in enumerate(data.get("sections", [])):
+        sid = s.setdefault("id", uuid.uuid4().hex)
+        by_id[sid] = i
+        if s.get("favorite"):
+            favorites.append(i)
+    data["by_id"] = by_id
+    data["favorites"] = favorites
+
+def find_section(data, section_id: str):
+    """Return (index, section) for `section_id`, or (None, None)."""
+    i = data.get("by_id", {}).get(section_id)
+    if i is None:
+        return None, None
+    return i, data["sections"][i]
+
+def favorite_sections(data):
+    return [(i, data["sections"][i]) for i in data.get("favorites", [])]
+
+def _set_favorite_index(data, index: int, favorite: bool):
+    favorites = data.setdefault("favorites", [])
+    pos = bisect.bisect_left(favorites, index)
+    present = pos < len(favorites) and favorites[pos] == index
+    if favorite and not present:
+        favorites.insert(pos, index)
+    elif not favorite and present:
+        del favorites[pos]
+
 def ensure_user_data(user_id: int):
+    """Create or migrate the user's file and return its parsed contents."""
     path = user_data_path(user_id)
     if not os.path.exists(path):
-        safe_write_json(path, default_user_structure())
-    else:
-        migrate_user_file(path)
-    return path
+        data = default_user_structure()
+        safe_write_json(path, data)
+        return data
+    return migrate_user_file(path)
+
+def _cache_user_data(user_id: int, data, sig=None):
+    _USER_DATA_CACHE[user_id] = data
+    _USER_DATA_CACHE.move_to_end(user_id)
+    _SEARCH_INDEX.pop(user_id, None)
+    if sig is not None:
+        _USER_DATA_STAT[user_id] = sig
+    while len(_USER_DATA_CACHE) > USER_CACHE_SIZE:
+        old_id, old_data = _USER_DATA_CACHE.popitem(last=False)
+        if old_id in _DIRTY:
+            _DIRTY.discard(old_id)
+            write_user_file(old_id, old_data)
+        _USER_DATA_STAT.pop(old_id, None)
+        _SEARCH_INDEX.pop(old_id, None)
+
+def _user_file_sig(user_id: int):
+    try:
+        st = os.stat(user_data_path(user_id))
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def _cached_user_data(user_id: int):
+    # A cached copy is stale if someone else rewrote the file; unflushed edits
+    # win, and so does the copy an off-loop save is still writing
+    data = _USER_DATA_CACHE.get(user_id)
+    if data is None:
+        return None
+    if (user_id not in _DIRTY and user_id not in _WRITING
+            and _USER_DATA_STAT.get(user_id) != _user_file_sig(user_id)):
+        return None
+    _USER_DATA_CACHE.move_to_end(user_id)
+    return data
+
+def _read_user_file(user_id: int):
+    data = ensure_user_data(user_id)
+    sig = _user_file_sig(user_id)
+    replay_op_log(user_id, data)
+    return data, sig
+
+def write_user_file(user_id: int, data, fsync=None, sync_dir: bool = True):
+    seq = data.get("log_seq", 0)
+    safe_write_json(user_data_path(user_id), data, fsync=fsync, sync_dir=sync_dir)
+    _user_file_written(user_id, data, seq)
+
+def _user_file_written(user_id: int, data, seq: int):
+    # The file holds every logged op up to `seq`, so the log can go, unless
+    # an op was appended (to whatever copy is cached now) while an off-loop
+    # write was in flight
+    current = _USER_DATA_CACHE.get(user_id, data)
+    _USER_DATA_STAT[user_id] = _user_file_sig(user_id)
+    if current.get("log_seq", 0) != seq:
+        return
+    try:
+        os.remove(op_log_path(user_id))
+    except FileNotFoundError:
+        pass
 
 def load_user_data(user_id: int):
-    ensure_user_data(user_id)
-    with open(user_data_path(user_id), "r", encoding="utf-8") as f:
-        return json.load(f)
+    data = _cached_user_data(user_id)
+    if data is not None:
+        return data
+    data, sig = _read_user_file(user_id)
+    _cache_user_data(user_id, data, sig)
+    return data
 
-def save_user_data(user_id: int, data):
-    safe_write_json(user_data_path(user_id), data)
+def _prepare_save(data):
+    # derived fields must match the sections before anything is cached or written
+    refresh_stats(data)
+    reindex_sections(data)
+
+def save_user_data(user_id: int, data, immediate: bool = False):
+    """Cache `data` and schedule a write; `immediate=True` writes it now."""
+    _prepare_save(data)
+    _cache_user_data(user_id, data)
+    if immediate:
+        _DIRTY.discard(user_id)
+        write_user_file(user_id, data)
+    else:
+        mark_dirty(user_id)
+
+# Async variants for handlers: disk I/O runs in a worker thread instead of
+# blocking the event loop. The cache itself is only touched from the loop.
+async def aload_user_data(user_id: int):
+    data = _cached_user_data(user_id)
+    if data is not None:
+        return data
+    data, sig = await asyncio.to_thread(_read_user_file, user_id)
+    cached = _cached_user_data(user_id)  # another task may have won the race
+    if cached is not None:
+        return cached
+    _cache_user_data(user_id, data, sig)
+    return data
+
+async def asave_user_data(user_id: int, data, immediate: bool = False):
+    if not immediate:
+        save_user_data(user_id, data)
+        return
+    _prepare_save(data)
+    _cache_user_data(user_id, data)
+    _DIRTY.discard(user_id)
+    seq = data.get("log_seq", 0)
+    # only the file write runs in the thread; the bookkeeping stays on the loop
+    _WRITING.add(user_id)
+    try:
+        await asyncio.to_thread(safe_write_json, user_data_path(user_id), data)
+    finally:
+        _WRITING.discard(user_id)
+    _user_file_written(user_id, data, seq)
+
+def mark_dirty(user_id: int):
+    _DIRTY.add(user_id)
+    _schedule_flush()
+
+def _schedule_flush():
+    global _FLUSH_HANDLE
+    if _FLUSH_HANDLE is not None:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # No event loop (startup, scripts): nothing would ever flush, so write now
+        flush_dirty_users()
+        return
+    _FLUSH_HANDLE = loop.call_later(FLUSH_DELAY, flush_dirty_users)
+
+def flush_dirty_users():
+    global _FLUSH_HANDLE, _USERS_DIRTY
+    _FLUSH_HANDLE = None
+    if not _DIRTY and not _USERS_DIRTY:
+        return
+    if _USERS_DIRTY:
+        _USERS_DIRTY = False
+        _write_users(_USERS_CACHE, sync_dir=False)
+    while _DIRTY:
+        user_id = _DIRTY.pop()
+        write_user_file(user_id, _USER_DATA_CACHE[user_id], sync_dir=False)
+    if FSYNC_ON_WRITE:
+        # one directory fsync covers every rename in the batch
+        fsync_dir(DATA_DIR)
+
+def _flush_on_exit():
+    flush_dirty_users()
+    if not FSYNC_ON_WRITE and hasattr(os, "sync"):
+        # writes skipped fsync; push everything to disk once on clean shutdown
+        os.sync()
+
+atexit.register(_flush_on_exit)
+
+# ---------- Passwords ----------
+# Stored as "scrypt$n$r$p$salt$hash" (hex); stdlib scrypt, no extra dependency.
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+
+def hash_password(password: str) -> str:
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+def check_password(password: str, stored: str) -> bool:
+    try:
+        _, n, r, p, salt, digest = stored.split("$")
+        expected = bytes.fromhex(digest)
+        candidate = hashlib.scrypt(
+            password.encode("utf-8"), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p)
+        )
+    except (ValueError, TypeError, AttributeError):
+        return False
+    return hmac.compare_digest(candidate, expected)
+
+def verify_login(user_id: int, password: str) -> bool:
+    """Check `password` for the user, upgrading a legacy plaintext entry on success."""
+    users = load_users()
+    entry = users.get(str(user_id))
+    if not isinstance(entry, dict):
+        return False
+    if "password_hash" in entry:
+        return check_password(password, entry["password_hash"])
+    legacy = entry.get("password")
+    if not isinstance(legacy, str) or not hmac.compare_digest(legacy.encode("utf-8"), password.encode("utf-8")):
+        return False
+    entry["password_hash"] = hash_password(password)
+    del entry["password"]
+    save_users(users)
+    return True
+
+def migrate_users_file():
+    """Replace any plaintext passwords left in USERS_FILE with hashes."""
+    users = load_users()
+    changed = False
+    for entry in users.values():
+        if isinstance(entry, dict) and "password" in entry:
+            entry["password_hash"] = hash_password(entry.pop("password"))
+            changed = True
+    if changed:
+        save_users(users)
 
 def is_logged_in(user_id: int) -> bool:
+    load_users()  # refresh the index if the file changed
+    return user_id in _LOGGED_IN
+
+def set_logged_in(user_id: int, logged_in: bool):
+    """Flip a registered user's session flag in the runtime set and in users.json."""
     users = load_users()
-    return str(user_id) in users and users[str(user_id)].get("logged_in", False)
+    entry = users.get(str(user_id))
+    if not isinstance(entry, dict) or entry.get("logged_in") == logged_in:
+        return  # unregistered ids never get an entry; nothing to write otherwise
+    entry["logged_in"] = logged_in
+    save_users(users)
+
+# ---------- Search ----------
+# All sections are joined into one lowercased blob, "title\x00text\x1e" each,
+# so a miss is a single substring scan; starts[i] is where section i begins
+# and starts[-1] is len(blob).
+def _search_blob(user_id: int, data):
+    entry = _SEARCH_INDEX.get(user_id)
+    if entry is None:
+        parts, starts, pos = [], [], 0
+        for s in data.get("sections", []):
+            part = f"{s.get('title', '')}\x00{s.get('text', '')}\x1e".lower()
+            parts.append(part)
+            starts.append(pos)
+            pos += len(part)
+        starts.append(pos)
+        entry = _SEARCH_INDEX[user_id] = ("".join(parts), starts)
+    return entry
+
+def search_sections(user_id: int, query: str):
+    """Return [(index, section)] whose title or text contains `query` (case-insensitive)."""
+    data = load_user_data(user_id)
+    q = query.lower()
+    if not q:
+        return list(enumerate(data["sections"]))
+    blob, starts = _search_blob(user_id, data)
+    hits = []
+    pos = blob.find(q)
+    while pos != -1:
+        i = bisect.bisect_right(starts, pos) - 1
+        hits.append((i, data["sections"][i]))
+        pos = blob.find(q, starts[i + 1])  # one hit per section is enough
+    return hits
+
+# ---------- Section op log ----------
+# Small section mutations append one line to data/<uid>.log.jsonl instead of
+# rewriting the whole user file (the snapshot). Ops carry a sequence number;
+# the snapshot records the last one it contains ("log_seq") so replay never
+# applies an op twice.
+def op_log_path(user_id: int) -> str:
+    return os.path.join(DATA_DIR, f"{user_id}.log.jsonl")
+
+def _apply_op(data, op):
+    index = op["index"]
+    if op["op"] == "trash":
+        section = data["sections"].pop(index)
+        _adjust_stats(data, section, -1)
+        section["deleted_at"] = op["ts"]
+        data["trash"].append(section)
+        reindex_sections(data)  # later positions shifted down
+    elif op["op"] == "edit":
+        section = data["sections"][index]
+        _adjust_stats(data, section, -1)
+        section[op["field"]] = op["value"]
+        section["updated_at"] = op["ts"]
+        _adjust_stats(data, section, 1)
+        if op["field"] == "favorite":
+            _set_favorite_index(data, index, bool(op["value"]))
+    else:
+        raise ValueError(f"Unknown op: {op['op']}")
+    data["log_seq"] = op["seq"]
+    return section
+
+def replay_op_log(user_id: int, data):
+    path = op_log_path(user_id)
+    if not os.path.exists(path):
+        return
+    good = 0
+    with open(path, "r+b") as f:
+        for line in f:
+            try:
+                op = json_loads(line)
+            except Exception:
+                # torn last line from a crash mid-append; cut it so new ops start clean
+                f.truncate(good)
+                break
+            good += len(line)
+            if op["seq"] > data.get("log_seq", 0) and op["index"] < len(data["sections"]):
+                _apply_op(data, op)
+
+def append_op(user_id: int, op):
+    """Log `op` for the user, apply it to the cached data and return the section."""
+    data = load_user_data(user_id)
+    if user_id in _DIRTY:
+        # logged indexes must refer to what is on disk
+        _DIRTY.discard(user_id)
+        write_user_file(user_id, data)
+    if not 0 <= op["index"] < len(data["sections"]):
+        raise IndexError(op["index"])
+    op = {**op, "seq": data.get("log_seq", 0) + 1, "ts": now_iso()}
+    line = json_line(op)
+    with open(op_log_path(user_id), "ab") as f:
+        f.write(line)
+        log_size = f.tell()
+        if FSYNC_ON_WRITE:
+            f.flush()
+            os.fsync(f.fileno())
+    if FSYNC_ON_WRITE and log_size == len(line):
+        fsync_dir(DATA_DIR)  # the log file itself is new
+    section = _apply_op(data, op)
+    _SEARCH_INDEX.pop(user_id, None)
+    snapshot = _USER_DATA_STAT.get(user_id)
+    if snapshot is None or log_size > LOG_COMPACT_RATIO * snapshot[1]:
+        save_user_data(user_id, data, immediate=True)
+    return section
+
+def trash_section(user_id: int, index: int):
+    """Move sections[index] to the trash and return it."""
+    return append_op(user_id, {"op": "trash", "index": index})
+
+def edit_section(user_id: int, index: int, field: str, value):
+    """Set one field of sections[index] (e.g. favorite, title, text)."""
+    return append_op(user_id, {"op": "edit", "index": index, "field": field, "value": value})
 
 # ---------- Migration ----------
-def migrate_user_file(path: str):
+_SCHEMA_VERSION_RE = re.compile(rb'"schema_version"\s*:\s*(\d+)')
+
+def needs_migration(path: str) -> bool:
+    # schema_version is the first key we write, so the head of the file is enough
+    with open(path, "rb") as f:
+        m = _SCHEMA_VERSION_RE.search(f.read(256))
+    return m is None or int(m.group(1)) < SCHEMA_VERSION
+
+def migrate_all_user_files(paths):
+    """Bring every user file to SCHEMA_VERSION in batches, off the request path."""
+    pending = [p for p in paths if needs_migration(p)]
+    if not pending:
+        return
+    done = 0
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as ex:
+        for i in range(0, len(pending), MIGRATION_BATCH):
+            batch = pending[i:i + MIGRATION_BATCH]
+            # files follow FSYNC_ON_WRITE; one directory fsync per batch
+            list(ex.map(lambda p: migrate_user_file(p, sync_dir=False), batch))
+            if FSYNC_ON_WRITE:
+                fsync_dir(DATA_DIR)
+            done += len(batch)
+            logger.info("Migrated %d/%d user files", done, len(pending))
+
+def migrate_user_file(path: str, fsync=None, sync_dir: bool = True):
+    """Load the user file at `path`, upgrading it to SCHEMA_VERSION if needed."""
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = read_json(path)
     except Exception:
         bak = path + ".corrupt.bak"
-        move(path, bak)
-        safe_write_json(path, default_user_structure())
-        return
+        os.replace(path, bak)
+        data = default_user_structure()
+        safe_write_json(path, data, fsync=fsync, sync_dir=sync_dir)
+        return data
     ver = data.get("schema_version", 1)
     changed = False
     if ver < 2:
         data.setdefault("trash", [])
         data.setdefault("settings", {"theme": "light"})
+        ts = now_iso()
         for s in data.get("sections", []):
-            s.setdefault("updated_at", datetime.now(timezone.utc).isoformat())
+            s.setdefault("updated_at", ts)
             s.setdefault("favorite", False)
         data["schema_version"] = 2
         changed = True
+    if ver < 3:
+        refresh_stats(data)
+        data["schema_version"] = 3
+        changed = True
+    if ver < 4:
+        reindex_sections(data)
+        data["schema_version"] = 4
+        changed = True
     if changed:
-        safe_write_json(path, data)
+        # keep schema_version first so needs_migration() can find it
+        data = {"schema_version": data["schema_version"], **data}
+        safe_write_json(path, data, fsync=fsync, sync_dir=sync_dir)
+    return data
 
 # ---------- Utilities ----------
+_ISO_CACHE = [None, ""]  # [whole second, its ISO string]
+
 def now_iso():
-    return datetime.now(timezone.utc).isoformat()
+    # 1-second granularity; repeated calls within the same second reuse the string
+    sec = int(time.time())
+    if sec != _ISO_CACHE[0]:
+        _ISO_CACHE[0] = sec
+        _ISO_CACHE[1] = datetime.fromtimestamp(sec, timezone.utc).isoformat()
+    return _ISO_CACHE[1]
 
+@lru_cache(maxsize=4096)
 def readable_iso(iso_str):
     try:
         dt = datetime.fromisoformat(iso_str)
@@ -163,37 +812,54 @@ def readable_iso(iso_str):
     except Exception:
         return iso_str
 
+# Keyed on the text itself, so any edit is a miss; str caches its hash, so
+# refresh_stats re-tokenizes only text it has not seen. Never persisted.
+@lru_cache(maxsize=16384)
 def count_words(text: str) -> int:
-    return len(text.strip().split())
+    # split() already ignores leading/trailing whitespace; it beats re.finditer here
+    return len(text.split())
 
 # ---------- UI helpers ----------
+# The menus are static, so build them once and share them
+_BACK_ROW = [InlineKeyboardButton("🔙 Back", callback_data="btn_back")]
+
+MENU_TEXT_LOGGED_IN = "✅ *You are logged in!* Choose an action:"
+MENU_MARKUP_LOGGED_IN = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Add", callback_data="menu_add"),
+     InlineKeyboardButton("📂 Show", callback_data="menu_show")],
+    [InlineKeyboardButton("✏️ Edit", callback_data="menu_edit"),
+     InlineKeyboardButton("🗑 Delete", callback_data="menu_delete")],
+    [InlineKeyboardButton("⭐ Favorites", callback_data="menu_fav"),
+     InlineKeyboardButton("🗃 Export", callback_data="menu_export")],
+    [InlineKeyboardButton("🗄 Backup", callback_data="menu_backup"),
+     InlineKeyboardButton("🔎 Search", callback_data="menu_search")],
+    [InlineKeyboardButton("🌓 Theme", callback_data="menu_theme"),
+     InlineKeyboardButton("🗑️ Trash", callback_data="menu_trash")],
+    [InlineKeyboardButton("📊 Stats", callback_data="menu_stats"),
+     InlineKeyboardButton("🏓 Ping", callback_data="menu_ping")],
+    [InlineKeyboardButton("🚪 Logout", callback_data="menu_logout")],
+    _BACK_ROW,
+])
+
+MENU_TEXT_LOGGED_OUT = "👋 *Welcome!* Please login or register to use the bot."
+MENU_MARKUP_LOGGED_OUT = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔑 Login", callback_data="login_panel"),
+     InlineKeyboardButton("🧾 Register", callback_data="register_panel")],
+    [InlineKeyboardButton("ℹ️ Help", callback_data="menu_help")],
+    _BACK_ROW,
+])
+
+LOGIN_PANEL_TEXT = "👤 *Login Panel*\nChoose an option:"
+LOGIN_PANEL_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔑 Login", callback_data="login_panel"),
+     InlineKeyboardButton("🧾 Register", callback_data="register_panel")],
+    _BACK_ROW,
+])
+
 def main_menu_markup(user_id: int):
     if is_logged_in(user_id):
-        kb = [
-            [InlineKeyboardButton("➕ Add", callback_data="menu_add"),
-             InlineKeyboardButton("📂 Show", callback_data="menu_show")],
-            [InlineKeyboardButton("✏️ Edit", callback_data="menu_edit"),
-             InlineKeyboardButton("🗑 Delete", callback_data="menu_delete")],
-            [InlineKeyboardButton("⭐ Favorites", callback_data="menu_fav"),
-             InlineKeyboardButton("🗃 Export", callback_data="menu_export")],
-            [InlineKeyboardButton("🗄 Backup", callback_data="menu_backup"),
-             InlineKeyboardButton("🔎 Search", callback_data="menu_search")],
-            [InlineKeyboardButton("🌓 Theme", callback_data="menu_theme"),
-             InlineKeyboardButton("🗑️ Trash", callback_data="menu_trash")],
-            [InlineKeyboardButton("📊 Stats", callback_data="menu_stats"),
-             InlineKeyboardButton("🏓 Ping", callback_data="menu_ping")],
-            [InlineKeyboardButton("🚪 Logout", callback_data="menu_logout")]
-        ]
-        text = "✅ *You are logged in!* Choose an action:"
-    else:
-        kb = [
-            [InlineKeyboardButton("🔑 Login", callback_data="login_panel"),
-             InlineKeyboardButton("🧾 Register", callback_data="register_panel")],
-            [InlineKeyboardButton("ℹ️ Help", callback_data="menu_help")]
-        ]
-        text = "👋 *Welcome!* Please login or register to use the bot."
-    kb.append([InlineKeyboardButton("🔙 Back", callback_data="btn_back")])
-    return text, InlineKeyboardMarkup(kb)
+        return MENU_TEXT_LOGGED_IN, MENU_MARKUP_LOGGED_IN
+    return MENU_TEXT_LOGGED_OUT, MENU_MARKUP_LOGGED_OUT
 
 # ---------- Conversation states ----------
 (
@@ -203,33 +869,34 @@ def main_menu_markup(user_id: int):
 ) = range(8)
 
 # ---------- Command handlers ----------
+HELP_TEXT = (
+    "📘 *Commands & Quick Guide*\n\n"
+    "/start - Open main menu\n"
+    "/login - Login panel (buttons)\n"
+    "/logout - Logout\n"
+    "/add - Add section (title, image URL or skip, text)\n"
+    "/show - Show your sections\n"
+    "/edit - Edit a section\n"
+    "/delete - Delete (move to Trash)\n"
+    "/trash - View Trash (restore or permanently delete)\n"
+    "/search - Search your sections\n"
+    "/export - Export all text to .txt\n"
+    "/backup - Download your data.json backup\n"
+    "/restore - Upload a backup JSON to restore\n"
+    "/stats - Show your stats (sections, favorites, words)\n"
+    "/ping - Bot uptime\n"
+    "/admin - Admin panel (admin only)\n\n"
+    "🔹 All UI is button-driven. Use *🔙 Back* to return to menus.\n"
+    "🔸 Passwords are stored locally (hashed)."
+)
+
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     text, markup = main_menu_markup(user.id)
     await update.message.reply_text(text, parse_mode=constants.ParseMode.MARKDOWN, reply_markup=markup)
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = (
-        "📘 *Commands & Quick Guide*\n\n"
-        "/start - Open main menu\n"
-        "/login - Login panel (buttons)\n"
-        "/logout - Logout\n"
-        "/add - Add section (title, image URL or skip, text)\n"
-        "/show - Show your sections\n"
-        "/edit - Edit a section\n"
-        "/delete - Delete (move to Trash)\n"
-        "/trash - View Trash (restore or permanently delete)\n"
-        "/search - Search your sections\n"
-        "/export - Export all text to .txt\n"
-        "/backup - Download your data.json backup\n"
-        "/restore - Upload a backup JSON to restore\n"
-        "/stats - Show your stats (sections, favorites, words)\n"
-        "/ping - Bot uptime\n"
-        "/admin - Admin panel (admin only)\n\n"
-        "🔹 All UI is button-driven. Use *🔙 Back* to return to menus.\n"
-        "🔸 Passwords are stored locally (plain text)."
-    )
-    await update.message.reply_text(help_text, parse_mode=constants.ParseMode.MARKDOWN)
+    await update.message.reply_text(HELP_TEXT, parse_mode=constants.ParseMode.MARKDOWN)
 
 async def ping_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uptime = int(time.time() - UPTIME_START)
@@ -238,13 +905,7 @@ async def ping_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---------- Login/Register ----------
 async def login_panel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    kb = [
-        [InlineKeyboardButton("🔑 Login", callback_data="login_panel"),
-         InlineKeyboardButton("🧾 Register", callback_data="register_panel")],
-        [InlineKeyboardButton("🔙 Back", callback_data="btn_back")]
-    ]
-    await update.message.reply_text("👤 *Login Panel*\nChoose an option:", parse_mode=constants.ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup(kb))
+    await update.message.reply_text(LOGIN_PANEL_TEXT, parse_mode=constants.ParseMode.MARKDOWN, reply_markup=LOGIN_PANEL_MARKUP)
 
 # ... 
 
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    # bot.py works on paths relative to the cwd, so each test gets its own
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data")
+    with open("data/users.json", "w", encoding="utf-8") as f:
+        f.write("{}")
+    import bot as module
+
+    for cache in (module._USER_DATA_CACHE, module._USER_DATA_STAT, module._SEARCH_INDEX,
+                  module._DIRTY, module._WRITING):
+        cache.clear()
+    monkeypatch.setattr(module, "_USERS_CACHE", None)
+    monkeypatch.setattr(module, "_FLUSH_HANDLE", None)
+    yield module
+    # nothing left for the atexit flush to write into another test's cwd
+    module._DIRTY.clear()
+    module._USERS_DIRTY = False
+
+
+def _reload(bot, user_id):
+    bot._USER_DATA_CACHE.clear()
+    bot._USER_DATA_STAT.clear()
+    return bot.load_user_data(user_id)
+
+
+def test_op_logged_during_async_save_survives(bot, monkeypatch):
+    data = bot.load_user_data(1)
+    data["sections"] = [{"title": "a"}, {"title": "b"}]
+    bot.save_user_data(1, data, immediate=True)
+
+    real_write = bot.safe_write_json
+    replaced = []
+
+    def slow_write(*args, **kwargs):
+        real_write(*args, **kwargs)
+        replaced.append(True)
+        time.sleep(0.2)  # the file is already replaced; the coroutine has not resumed
+
+    async def scenario():
+        monkeypatch.setattr(bot, "safe_write_json", slow_write)
+        save = asyncio.create_task(bot.asave_user_data(1, data, immediate=True))
+        while not replaced:
+            await asyncio.sleep(0.01)
+        monkeypatch.setattr(bot, "safe_write_json", real_write)
+        bot.edit_section(1, 1, "favorite", True)
+        await save
+
+    asyncio.run(scenario())
+    assert os.path.exists(bot.op_log_path(1))
+    reloaded = _reload(bot, 1)
+    assert reloaded["sections"][1]["favorite"] is True
+    assert reloaded["favorites"] == [1]
+
+
+def test_same_length_text_edit_recounts_words(bot):
+    data = bot.load_user_data(1)
+    data["sections"] = [{"title": "a", "text": "ab cd"}]
+    bot.save_user_data(1, data, immediate=True)
+    assert data["stats"]["total_words"] == 2
+
+    data["sections"][0]["text"] = "abcde"
+    bot.save_user_data(1, data, immediate=True)
+    assert data["stats"]["total_words"] == 1
+
+    bot.edit_section(1, 0, "text", "a b c")
+    assert data["stats"]["total_words"] == 3
+    bot.edit_section(1, 0, "text", "a bcd")
+    assert data["stats"]["total_words"] == 2
+    assert _reload(bot, 1)["stats"]["total_words"] == 2
+
+    with open(bot.user_data_path(1), "rb") as f:
+        assert b"_wc" not in f.read()